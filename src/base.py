@@ -43,7 +43,7 @@ class Agent:
         # Preprocessing state
         state = self.prep_state(state)
         
-        return random.choice(np.arange(self.action_size)).astype(int)
+        return random.randrange(self.action_size)
 
     def step(self, state: np.ndarray, action: int, reward: float,
              next_state: np.ndarray, done: bool, i: int):
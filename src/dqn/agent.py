@@ -1,10 +1,10 @@
 import random
+import inspect
 import logging
 import numpy as np
-from typing import Tuple, Any
+from typing import Tuple, Any, Optional
 
 import torch
-import torch.nn.functional as F
 import torch.optim as optim
 
 from src.dqn.network import QNetwork
@@ -15,6 +15,44 @@ _logger = logging.getLogger(__name__)
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+# Allow TF32 tensor-core matmuls on Ampere+ GPUs (no-op on CPU and older GPUs)
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+if hasattr(torch, "set_float32_matmul_precision"):
+    torch.set_float32_matmul_precision("high")
+
+
+def bellman_targets(Q_targets_next: torch.Tensor, rewards: torch.Tensor, not_dones: torch.Tensor,
+                    gamma: float) -> torch.Tensor:
+    """Compute the Q targets r + γ * max_a' Q_target(s', a') * (1 - done)."""
+    return torch.addcmul(rewards, Q_targets_next, not_dones, value=gamma)
+
+
+def bellman_losses(Q_expected: torch.Tensor, Q_targets_next: torch.Tensor, rewards: torch.Tensor,
+                   not_dones: torch.Tensor, gamma: float,
+                   sampling_weights: Optional[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Compute the MSE loss against the Q targets in a single fused pass.
+
+    Returns:
+    - loss: mean squared TD error, weighted by sampling_weights when given
+    - squared_errors: squared TD error of each experience
+    """
+    diff = Q_expected - bellman_targets(Q_targets_next, rewards, not_dones, gamma)
+    squared_errors = (diff * diff).squeeze(1)
+    if sampling_weights is None:
+        loss = squared_errors.mean()
+    else:
+        loss = (squared_errors * sampling_weights).mean()
+    return loss, squared_errors
+
+
+# Without torch.compile (torch < 2.0), TorchScript fuses the Bellman elementwise ops instead
+if not hasattr(torch, "compile"):
+    bellman_targets = torch.jit.script(bellman_targets)
+    bellman_losses = torch.jit.script(bellman_losses)
+
 
 class Agent(Agent):
     """Interacts with and learns from the environment."""
@@ -23,10 +61,10 @@ class Agent(Agent):
                  nb_hidden: tuple = (64, 64), learning_rate: float = 5e-4,
                  memory_size: int = int(1e5), prioritized_memory: bool = False,
                  batch_size: int = 64, gamma: float = 0.99, tau: float = 1e-3,
-                 small_eps: float = 1e-5, update_every: int = 4,
+                 small_eps: float = 1e-5, update_every: int = 4, soft_update_every: int = 32,
                  epsilon_enabled: bool = True, epsilon_start: float = 1.0,
                  epsilon_end: float = 0.01, epsilon_decay: float = 0.995,
-                 **kwargs):
+                 mixed_precision: bool = True, **kwargs):
         """
         Initialize a Deep Q-Network agent.
         
@@ -43,10 +81,12 @@ class Agent(Agent):
         - tau: interpolation parameter for target network.
         - small_eps: small value used in the priority update.
         - update_every: number of steps before updating the target network.
+        - soft_update_every: number of learning steps between soft updates of the target network.
         - epsilon_enabled: if True, use epsilon-greedy action selection.
         - epsilon_start: starting value of epsilon, for epsilon-greedy action selection.
         - epsilon_end: minimum value of epsilon.
         - epsilon_decay: decay rate for epsilon.
+        - mixed_precision: if True, use automatic mixed precision in learn() (CUDA only).
         """
         self.state_size = state_size
         self.action_size = action_size
@@ -59,10 +99,12 @@ class Agent(Agent):
         self.tau = tau
         self.small_eps = small_eps
         self.update_every = update_every
+        self.soft_update_every = soft_update_every
         self.epsilon_enabled = epsilon_enabled
         self.epsilon_start = epsilon_start
         self.epsilon_end = epsilon_end
         self.epsilon_decay = epsilon_decay
+        self.mixed_precision = mixed_precision and device.type == "cuda"
 
         # Initialize epsilon
         if self.epsilon_enabled:
@@ -70,12 +112,48 @@ class Agent(Agent):
         else:
             self.epsilon = 0.0
 
-        self.losses = []
+        # Precomputed epsilon schedule and pre-drawn random numbers for the epsilon-greedy policy
+        self._eps_schedule = self._build_eps_schedule()
+        self._eps_step = 0
+        self._rng = np.random.default_rng(seed)
+        self._rand_buf = self._rng.random(8192)
+        self._rand_idx = 0
+
+        # On-device ring buffer with the last 100 losses; it is copied to the
+        # host loss history once per wrap, instead of syncing on every learning step
+        self._loss_history = []
+        self._loss_ring = torch.zeros(100, device=device)
+        self._loss_idx = 0
+        self._loss_count = 0
 
         # Q-Network
         self.qnet_local = QNetwork(self.state_size, self.action_size, layers=nb_hidden, seed=seed).to(device)
-        self.qnet_target = QNetwork(self.state_size, self.action_size, layers=nb_hidden, seed=seed).to(device)       
-        self.optimizer = optim.Adam(self.qnet_local.parameters(), lr=self.learning_rate)
+        self.qnet_target = QNetwork(self.state_size, self.action_size, layers=nb_hidden, seed=seed).to(device)
+
+        # Compile the fixed-shape loss computation of learn() (torch.compile is only available
+        # from torch 2.0). Dynamo cannot trace ScriptModules, so the networks stay eager here;
+        # without torch.compile they are TorchScripted instead.
+        if hasattr(torch, "compile"):
+            self._compute_loss = torch.compile(self.compute_loss, mode="reduce-overhead", dynamic=False)
+        else:
+            self.qnet_local = torch.jit.script(self.qnet_local)
+            self.qnet_target = torch.jit.script(self.qnet_target)
+            self._compute_loss = self.compute_loss
+
+        # The target network is only updated through soft_update(), never by gradients
+        for param in self.qnet_target.parameters():
+            param.requires_grad_(False)
+
+        # Single-kernel fused Adam on CUDA (the fused option is only available from torch 1.13)
+        adam_kwargs = {}
+        if device.type == "cuda" and "fused" in inspect.signature(optim.Adam).parameters:
+            adam_kwargs["fused"] = True
+        self.optimizer = optim.Adam(self.qnet_local.parameters(), lr=self.learning_rate, **adam_kwargs)
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.mixed_precision)
+
+        # Parameter lists used by the fused (foreach) soft update
+        self._local_params = list(self.qnet_local.parameters())
+        self._target_params = list(self.qnet_target.parameters())
 
         # Define memory
         if self.prioritized_memory:
@@ -85,9 +163,43 @@ class Agent(Agent):
             
         # Initialize time step (for updating every UPDATE_EVERY steps)
         self.t_step = 0
+        self._soft_update_counter = 0
+
+        # Staging buffer for the state fed to the network in act()
+        self._act_state_buf = torch.empty((1, self.state_size), dtype=torch.float32,
+                                          pin_memory=torch.cuda.is_available())
+
+        # On CUDA, learn() runs on its own stream so it can overlap with the environment rollout
+        self._learn_stream = torch.cuda.Stream() if device.type == "cuda" else None
+
+        # On CUDA, the act() forward pass is replayed from a captured graph
+        # (torch.cuda.CUDAGraph is only public from torch 1.10; older versions use the eager path)
+        self._act_graph = None
+        if device.type == "cuda" and hasattr(torch.cuda, "CUDAGraph"):
+            self._capture_act_graph()
 
         _logger.info("DQN Agent initialized.")
 
+    def _capture_act_graph(self):
+        """
+        Capture the forward pass used in act() in a CUDA graph.
+        The graph reads its input from self._act_in and writes to self._act_out;
+        the network weights are updated in place, so replays always use the current ones.
+        """
+        self._act_in = torch.zeros((1, self.state_size), device=device)
+
+        # Warm up and capture on a side stream, as required by CUDA graphs
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream), torch.no_grad():
+            for _ in range(3):
+                self.qnet_local(self._act_in)
+            self._act_graph = torch.cuda.CUDAGraph()
+            self._act_graph.capture_begin()
+            self._act_out = self.qnet_local(self._act_in)
+            self._act_graph.capture_end()
+        torch.cuda.current_stream().wait_stream(stream)
+
     def logs(self):
         """
         Get the logs of the agent.
@@ -95,13 +207,20 @@ class Agent(Agent):
         Returns:
         - A string with the log message.
         """
-        # Compute the avg loss of the last 100 episodes
-        if len(self.losses) > 0:
-            avg_loss = int(torch.mean(torch.stack(self.losses[-100:])))
+        # Compute the avg loss of the last 100 learning steps
+        if self._loss_count > 0:
+            self._wait_learn_stream()
+            avg_loss = float(self._loss_ring[:self._loss_count].mean().item())
         else:
             avg_loss = float("inf")
 
-        return f"Epsilon: {self.epsilon:.2f}\tAvg. MSE Loss: {avg_loss:.2f}"
+        return f"Epsilon: {self.epsilon:.2f}\tAvg. MSE Loss: {avg_loss:.4f}"
+
+    @property
+    def losses(self) -> list:
+        """Loss of each learning step so far."""
+        self._wait_learn_stream()
+        return self._loss_history + self._loss_ring[:self._loss_idx].tolist()
         
     def step(self, state: np.ndarray, action: int, reward: int,
              next_state: np.ndarray, done: bool, episode: int, **kwargs):
@@ -132,18 +251,45 @@ class Agent(Agent):
         if self.t_step == 0:
             # If enough samples are available in memory, get random subset and learn
             if len(self.memory) > self.batch_size:
-                if self.prioritized_memory:
-                    experiences = self.memory.sample(self.get_beta(episode))
-                else:
-                    experiences = self.memory.sample()
-                    
-                self.learn(experiences)             
+                # Learn on a side stream (CUDA only), after the work already queued by act()
+                if self._learn_stream is not None:
+                    self._learn_stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(self._learn_stream):
+                    if self.prioritized_memory:
+                        experiences = self.memory.sample(self.get_beta(episode))
+                    else:
+                        experiences = self.memory.sample()
+
+                    self.learn(experiences)
+
+    def _wait_learn_stream(self):
+        """Make the current CUDA stream wait for the work queued on the learning stream."""
+        if self._learn_stream is not None:
+            torch.cuda.current_stream().wait_stream(self._learn_stream)
+
+    def _build_eps_schedule(self) -> np.ndarray:
+        """
+        Precompute epsilon for each act() call, until it reaches epsilon_end.
+
+        Returns:
+        - schedule: epsilon values, the last one is kept afterwards.
+        """
+        eps_floor = max(self.epsilon_end, 1e-8)
+        if 0 < self.epsilon_decay < 1 and self.epsilon_start > eps_floor:
+            n_steps = int(np.ceil(np.log(eps_floor / self.epsilon_start) / np.log(self.epsilon_decay)))
+        else:
+            n_steps = 1
+
+        schedule = np.maximum(self.epsilon_end, self.epsilon_start * self.epsilon_decay ** np.arange(n_steps + 1))
+        schedule[0] = self.epsilon_start
+        return schedule.astype(np.float32)
 
     def decay_eps(self):
         """
         Decay epsilon-greedy used for action selection.
         """
-        self.epsilon = max(self.epsilon_end, self.epsilon_decay * self.epsilon)
+        self._eps_step = min(self._eps_step + 1, len(self._eps_schedule) - 1)
+        self.epsilon = float(self._eps_schedule[self._eps_step])
 
     def act(self, state: np.ndarray) -> int:
         """Returns actions for given state as per current policy.
@@ -156,21 +302,36 @@ class Agent(Agent):
         """
         _logger.debug(f"Acting on state {state}")
 
-        # Preprocessing state
-        state = self.prep_state(state)
-
-        state = torch.from_numpy(state).float().unsqueeze(0).to(device)
-
-        self.qnet_local.eval()
-        with torch.no_grad():
-            action_values = self.qnet_local(state)
-        self.qnet_local.train()
+        # Epsilon-greedy action selection (the state is only preprocessed and
+        # fed to the network when exploiting)
+        explore = False
+        if self.epsilon_enabled:
+            if self._rand_idx == len(self._rand_buf):
+                self._rand_buf = self._rng.random(len(self._rand_buf))
+                self._rand_idx = 0
+            explore = self._rand_buf[self._rand_idx] < self.epsilon
+            self._rand_idx += 1
 
-        # Epsilon-greedy action selection
-        if self.epsilon_enabled and random.random() < self.epsilon:
+        if explore:
             action = random.randrange(self.action_size)
         else:
-            action = np.argmax(action_values.cpu().data.numpy()).astype(int)
+            state = self.prep_state(state)
+            self._act_state_buf.copy_(torch.as_tensor(state).unsqueeze(0))
+
+            # The forward pass must see the weights from the last learning step
+            self._wait_learn_stream()
+            if self._act_graph is not None:
+                self._act_in.copy_(self._act_state_buf, non_blocking=True)
+                self._act_graph.replay()
+                action_values = self._act_out
+            else:
+                state = self._act_state_buf.to(device, non_blocking=True)
+                self.qnet_local.eval()
+                with torch.no_grad():
+                    action_values = self.qnet_local(state)
+                self.qnet_local.train()
+
+            action = int(action_values.argmax(dim=1).item())
             
         if self.epsilon_enabled:
             self.decay_eps()
@@ -184,47 +345,86 @@ class Agent(Agent):
         Update value parameters using given batch of experience tuples.
         
         Args:
-        - experiences: tuple of (s, a, r, s', done) tuples
+        - experiences: tuple of (s, a, r, s', 1 - done) tuples
         """
         _logger.debug("Starting learning.")
 
         if self.prioritized_memory:
-            states, actions, rewards, next_states, dones, index, sampling_weights = experiences
+            states, actions, rewards, next_states, not_dones, index, sampling_weights = experiences
         else:
-            states, actions, rewards, next_states, dones = experiences
-
-        # Get max predicted Q values (for next states) from target model
-        Q_targets_next = self.qnet_target(next_states).detach().max(1)[0].unsqueeze(1)
-        # Compute Q targets for current states 
-        Q_targets = rewards + (self.gamma * Q_targets_next * (1 - dones))
-
-        # Get expected Q values from local model
-        Q_expected = self.qnet_local(states).gather(1, actions)
+            states, actions, rewards, next_states, not_dones = experiences
+            sampling_weights = None
 
         # Compute loss
+        with torch.cuda.amp.autocast(enabled=self.mixed_precision):
+            loss, squared_errors = self._compute_loss(states, actions, rewards, next_states,
+                                                      not_dones, sampling_weights)
+
         if self.prioritized_memory:
-            loss = self.mse_loss_prioritized(Q_expected, Q_targets, index, sampling_weights)
-        else:
-            loss = F.mse_loss(Q_expected, Q_targets)
+            self.update_priorities(index, squared_errors)
 
-        self.losses.append(loss)
+        self._loss_ring[self._loss_idx] = loss.detach()
+        self._loss_idx = (self._loss_idx + 1) % len(self._loss_ring)
+        self._loss_count = min(self._loss_count + 1, len(self._loss_ring))
+        if self._loss_idx == 0:
+            self._loss_history.extend(self._loss_ring.tolist())
 
         # Minimize the loss
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.scaler.scale(loss).backward()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
 
-        # Update target network
-        self.soft_update()
+        # Update target network every soft_update_every learning steps,
+        # with the tau equivalent to that many consecutive soft updates
+        self._soft_update_counter += 1
+        if self._soft_update_counter >= self.soft_update_every:
+            self.soft_update(1.0 - (1.0 - self.tau) ** self.soft_update_every)
+            self._soft_update_counter = 0
 
         _logger.debug("Finished learning.")                     
 
-    def soft_update(self):
+    def compute_loss(self, states: torch.Tensor, actions: torch.Tensor, rewards: torch.Tensor,
+                     next_states: torch.Tensor, not_dones: torch.Tensor,
+                     sampling_weights: torch.Tensor = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Compute the MSE loss for a batch of experiences.
+
+        Args:
+        - states: current states
+        - actions: actions taken
+        - rewards: rewards received
+        - next_states: next states
+        - not_dones: 1 - done for each experience
+        - sampling_weights: weights of the experiences (prioritized memory only)
+
+        Returns:
+        - loss: mse loss
+        - squared_errors: squared TD error of each experience
+        """
+        # Get max predicted Q values (for next states) from target model
+        with torch.no_grad():
+            Q_targets_next = self.qnet_target(next_states).max(1, keepdim=True)[0]
+
+        # Get expected Q values from local model
+        Q_expected = self.qnet_local(states).gather(1, actions)
+
+        return bellman_losses(Q_expected, Q_targets_next, rewards, not_dones,
+                              float(self.gamma), sampling_weights)
+
+    def soft_update(self, tau: float = None):
         """Soft update model parameters.
         θ_target = τ*θ_local + (1 - τ)*θ_target
+
+        Args:
+        - tau: interpolation parameter (defaults to self.tau).
         """
-        for target_param, local_param in zip(self.qnet_target.parameters(), self.qnet_local.parameters()):
-            target_param.data.copy_(self.tau * local_param.data + (1.0 - self.tau) * target_param.data)
+        if tau is None:
+            tau = self.tau
+
+        with torch.no_grad():
+            torch._foreach_mul_(self._target_params, 1.0 - tau)
+            torch._foreach_add_(self._target_params, self._local_params, alpha=tau)
 
     def save_model(self, path: str):
         """
@@ -235,6 +435,7 @@ class Agent(Agent):
         """
         _logger.debug(f"Saving model to path: {path}")
 
+        self._wait_learn_stream()
         torch.save(self.qnet_local.state_dict(), path)
 
     def load_model(self, path: str):
@@ -246,6 +447,7 @@ class Agent(Agent):
         """
         _logger.debug(f"Loading model from path: {path}")
         
+        self._wait_learn_stream()
         self.qnet_local.load_state_dict(torch.load(path))
     
     def get_beta(self, i: int, beta_start: float = 0.4, beta_end: int = 1, beta_growth: float = 1.05):
@@ -267,20 +469,14 @@ class Agent(Agent):
         beta = min(beta_start * (beta_growth ** i), beta_end)
         return beta
 
-    def mse_loss_prioritized(self, Q_expected: torch.Tensor, Q_targets: torch.Tensor,
-                             index: np.ndarray, sampling_weights: torch.Tensor):
+    def update_priorities(self, index: np.ndarray, squared_errors: torch.Tensor):
         """
-        Compute the loss for prioritized experience replay.
+        Update the priorities of the sampled experiences in prioritized memory.
 
         Args:
-        - Q_expected: expected Q values
-        - Q_targets: target Q values
         - index: indices of the experiences
-        - sampling_weights: weights of the experiences
-
-        Returns:
-        - loss: mse loss
+        - squared_errors: squared TD error of each experience
         """
-        losses = F.mse_loss(Q_expected, Q_targets, reduce=False).squeeze(1) * sampling_weights
-        self.memory.update_priority(index, losses + self.small_eps)
-        return losses.mean()
+        with torch.no_grad():
+            priorities = (squared_errors.detach().float() + self.small_eps).cpu().numpy()
+        self.memory.update_priority(np.asarray(index), priorities)
@@ -13,8 +13,10 @@ class AgentConfig(BaseModel):
     tau: float = 0.001
     small_eps: float = 0.03
     update_every: int = 4
+    soft_update_every: int = 32
     epsilon_enabled: bool = True
     epsilon_start: float = 1.0
     epsilon_end: float = 0.01
     epsilon_decay: float = 0.99995
+    mixed_precision: bool = True
     model_dir: str = "./DQN.pt"
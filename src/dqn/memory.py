@@ -2,13 +2,178 @@ import torch
 import random
 import logging
 import numpy as np
-from collections import namedtuple, deque
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 _logger = logging.getLogger(__name__)
 
-class PrioritizedMemory:
+class PinnedTransfer:
+    """
+    Copies sampled batches to the device through reusable pinned host buffers,
+    so the host-to-device copies are asynchronous.
+    """
+    def __init__(self):
+        """Initialize a PinnedTransfer object."""
+        self.buffers = None
+        self.event = None
+
+    def to_device(self, *arrays: np.ndarray) -> tuple:
+        """
+        Copy host arrays to the device.
+
+        Args:
+        - arrays: numpy arrays, already in the target dtype
+
+        Returns:
+        - tensors: device tensors, one per array
+        """
+        if device.type != "cuda":
+            return tuple(torch.from_numpy(array) for array in arrays)
+
+        # The previous copies must be done before the pinned buffers are overwritten
+        if self.event is not None:
+            self.event.synchronize()
+
+        if self.buffers is None or [b.shape for b in self.buffers] != [torch.Size(a.shape) for a in arrays]:
+            self.buffers = [torch.empty(a.shape, dtype=torch.from_numpy(a).dtype, pin_memory=True) for a in arrays]
+
+        tensors = []
+        for buffer, array in zip(self.buffers, arrays):
+            buffer.copy_(torch.from_numpy(array))
+            tensors.append(buffer.to(device, non_blocking=True))
+
+        self.event = torch.cuda.Event()
+        self.event.record()
+        return tuple(tensors)
+
+class SumTree:
+    """
+    Binary tree where each parent node holds the sum of its children.
+    Leaves store the priorities, so updates and prefix-sum lookups are O(log N).
+    """
+    def __init__(self, capacity: int):
+        """Initialize a SumTree object.
+
+        Parameters:
+        - capacity: number of leaves (rounded up to the next power of two)
+        """
+        self.capacity = 1 << max(1, (capacity - 1).bit_length())
+        self.tree = np.zeros(2 * self.capacity)
+
+    def total(self) -> float:
+        """Return the sum of all priorities."""
+        return self.tree[1]
+
+    def get(self, indexes: np.ndarray) -> np.ndarray:
+        """Return the priorities stored at the given leaves."""
+        return self.tree[np.asarray(indexes) + self.capacity]
+
+    def update(self, indexes: np.ndarray, priorities: np.ndarray):
+        """
+        Set the priorities of the given leaves and propagate the sums to the root.
+
+        Args:
+        - indexes: leaf indexes
+        - priorities: new priorities
+        """
+        nodes = np.atleast_1d(np.asarray(indexes) + self.capacity)
+        self.tree[nodes] = priorities
+        # All leaves are at the same depth, so each level is updated in one go
+        nodes = np.unique(nodes // 2)
+        while True:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            if nodes[0] == 1:
+                break
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values: np.ndarray) -> np.ndarray:
+        """
+        Find the leaves whose cumulative priority range contains each value.
+
+        Args:
+        - values: values in [0, total)
+
+        Returns:
+        - indexes: leaf indexes
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while nodes[0] < self.capacity:
+            left = 2 * nodes
+            go_right = values >= self.tree[left]
+            values -= np.where(go_right, self.tree[left], 0.0)
+            nodes = left + go_right
+        return nodes - self.capacity
+
+
+class ReplayMemory:
+    """Fixed-size memory to store experience tuples."""
+
+    def __init__(self, memory_size: int, batch_size: int):
+        """Initialize a ReplayMemory object.
+
+        Parameters:
+        - memory_size: maximum size of memory
+        - batch_size: size of each training batch
+        """
+        self.memory_size = memory_size
+        self.batch_size = batch_size
+        self.position = 0
+        self.size = 0
+        self._transfer = PinnedTransfer()
+
+        # Experiences are stored column-wise; the arrays are allocated on the first add()
+        self.states = None
+        self.actions = None
+        self.rewards = None
+        self.next_states = None
+        self.not_dones = None
+    
+        _logger.info(f"Replay Memory initialized with size: {self.memory_size}")
+
+    def _allocate(self, state: np.ndarray):
+        """Allocate the storage arrays using the shape of the first state."""
+        state_shape = (self.memory_size,) + np.shape(state)
+        self.states = np.empty(state_shape, dtype=np.float32)
+        self.actions = np.empty((self.memory_size, 1), dtype=np.int64)
+        self.rewards = np.empty((self.memory_size, 1), dtype=np.float32)
+        self.next_states = np.empty(state_shape, dtype=np.float32)
+        self.not_dones = np.empty((self.memory_size, 1), dtype=np.float32)
+
+    def add(self, state: np.ndarray, action: int, reward: float, next_state: np.ndarray, done: bool):
+        """Add a new experience to memory."""
+        _logger.debug("Adding new experience to memory.")
+        if self.states is None:
+            self._allocate(state)
+
+        self.states[self.position] = state
+        self.actions[self.position] = action
+        self.rewards[self.position] = reward
+        self.next_states[self.position] = next_state
+        # Stored as a 1 - done mask, ready to multiply in the Bellman target
+        self.not_dones[self.position] = 1.0 - float(done)
+
+        self.position = (self.position + 1) % self.memory_size
+        self.size = min(self.size + 1, self.memory_size)
+
+    def _gather(self, index: np.ndarray) -> tuple:
+        """Gather the experiences at the given indexes."""
+        return (self.states[index], self.actions[index], self.rewards[index],
+                self.next_states[index], self.not_dones[index])
+    
+    def sample(self):
+        """Randomly sample a batch of experiences from memory."""
+        index = np.array(random.sample(range(self.size), k=self.batch_size))
+        
+        states, actions, rewards, next_states, not_dones = self._transfer.to_device(*self._gather(index))
+  
+        return (states, actions, rewards, next_states, not_dones)
+
+    def __len__(self):
+        """Return the current size of internal memory."""
+        return self.size
+
+class PrioritizedMemory(ReplayMemory):
     """
     Fixed-size memory to store experience tuples with sampling weights.
     PRIORITIZED EXPERIENCE REPLAY - https://arxiv.org/pdf/1511.05952.pdf
@@ -21,13 +186,10 @@ class PrioritizedMemory:
         - batch_size: size of each training batch
         - alpha: determines how much prioritization is used
         """
-        self.memory_size = memory_size
-        self.memory = deque(maxlen=memory_size)
+        super(PrioritizedMemory, self).__init__(memory_size, batch_size)
         self.alpha = alpha
-        self.batch_size = batch_size
-        self.priority = deque(maxlen=memory_size)
-        self.probabilities = np.zeros(memory_size)
-        self.experience = namedtuple("Experience", field_names=["state", "action", "reward", "next_state", "done"])
+        self.tree = SumTree(memory_size)
+        self.max_priority = 1.0
         
         _logger.info(f"Prioritized Memory initialized with size: {self.memory_size}")
 
@@ -41,12 +203,9 @@ class PrioritizedMemory:
         - next_state: next state
         - done: whether the episode is done
         """
-        _logger.debug(f"Adding new experience to memory.")
-        priority_max = max(self.priority) if self.memory else 1
-        e = self.experience(state, action, reward, next_state, done)
-        
-        self.memory.append(e)
-        self.priority.append(priority_max)
+        # New experiences get the highest priority seen so far
+        self.tree.update(self.position, self.max_priority ** self.alpha)
+        super(PrioritizedMemory, self).add(state, action, reward, next_state, done)
     
     def sample(self, beta: float = 0.4):
         """Sample a batch of experiences from prioritized memory.
@@ -56,28 +215,20 @@ class PrioritizedMemory:
         """
         _logger.debug("Sampling batch of experiences.")
 
-        self.update_probabilities()
-        index = np.random.choice(range(self.memory_size), self.batch_size, replace=False, p=self.probabilities)
-        experiences = [self.memory[i] for i in index]
-        
-        states = torch.from_numpy(np.vstack([e.state for e in experiences if e is not None])).float().to(device)
-        actions = torch.from_numpy(np.vstack([e.action for e in experiences if e is not None])).long().to(device)
-        rewards = torch.from_numpy(np.vstack([e.reward for e in experiences if e is not None])).float().to(device)
-        next_states = torch.from_numpy(np.vstack([e.next_state for e in experiences if e is not None])).float().to(device)
-        dones = torch.from_numpy(np.vstack([e.done for e in experiences if e is not None]).astype(np.uint8)).float().to(device)
-  
+        # Stratified sampling: one value from each of batch_size equal segments of the total priority
+        total = self.tree.total()
+        values = (np.arange(self.batch_size) + np.random.random(self.batch_size)) * (total / self.batch_size)
+        index = np.minimum(self.tree.find(values), self.__len__() - 1)
+
         # Calculate sampling weights
-        sampling_weights = (self.__len__()*self.probabilities[index])**(-beta)
+        probabilities = self.tree.get(index) / total
+        sampling_weights = (self.__len__()*probabilities)**(-beta)
         sampling_weights = sampling_weights / np.max(sampling_weights)
-        sampling_weights = torch.from_numpy(sampling_weights).float().to(device)
+
+        states, actions, rewards, next_states, not_dones, sampling_weights = self._transfer.to_device(
+            *self._gather(index), sampling_weights.astype(np.float32))
         
-        return (states, actions, rewards, next_states, dones, index, sampling_weights)
-    
-    def update_probabilities(self):
-        """Update sampling probabilities."""
-        probabilities = np.array([i**self.alpha for i in self.priority])
-        self.probabilities[range(len(self.priority))] = probabilities
-        self.probabilities /= np.sum(self.probabilities)
+        return (states, actions, rewards, next_states, not_dones, index, sampling_weights)
         
     def update_priority(self, indexes: np.ndarray, losses: np.ndarray):
         """
@@ -87,48 +238,6 @@ class PrioritizedMemory:
         - indexes: indexes of sampled experiences
         - losses: losses of sampled experiences
         """
-        for index, loss in zip(indexes, losses):
-            self.priority[index] = loss.data
-    
-    def __len__(self):
-        """Return the current size of internal memory."""
-        return len(self.memory)
-        
-class ReplayMemory:
-    """Fixed-size memory to store experience tuples."""
-
-    def __init__(self, memory_size: int, batch_size: int):
-        """Initialize a ReplayMemory object.
-
-        Parameters:
-        - memory_size: maximum size of memory
-        - batch_size: size of each training batch
-        """
-        self.memory_size = memory_size
-        self.memory = deque(maxlen=memory_size)  
-        self.batch_size = batch_size
-        self.experience = namedtuple("Experience", field_names=["state", "action", "reward", "next_state", "done"])
-    
-        _logger.info(f"Replay Memory initialized with size: {self.memory_size}")
-
-    def add(self, state: np.ndarray, action: int, reward: float, next_state: np.ndarray, done: bool):
-        """Add a new experience to memory."""
-        _logger.debug("Adding new experience to memory.")
-        e = self.experience(state, action, reward, next_state, done)
-        self.memory.append(e)
-    
-    def sample(self):
-        """Randomly sample a batch of experiences from memory."""
-        experiences = random.sample(self.memory, k=self.batch_size)
-        
-        states = torch.from_numpy(np.vstack([e.state for e in experiences if e is not None])).float().to(device)
-        actions = torch.from_numpy(np.vstack([e.action for e in experiences if e is not None])).long().to(device)
-        rewards = torch.from_numpy(np.vstack([e.reward for e in experiences if e is not None])).float().to(device)
-        next_states = torch.from_numpy(np.vstack([e.next_state for e in experiences if e is not None])).float().to(device)
-        dones = torch.from_numpy(np.vstack([e.done for e in experiences if e is not None]).astype(np.uint8)).float().to(device)
-  
-        return (states, actions, rewards, next_states, dones)
-
-    def __len__(self):
-        """Return the current size of internal memory."""
-        return len(self.memory)
\ No newline at end of file
+        priorities = np.asarray(losses, dtype=np.float64)
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.tree.update(np.asarray(indexes), priorities ** self.alpha)